@@ -1,17 +1,118 @@
+import json
 import logging
-from typing import Optional, List, Dict, Tuple, Any
+from typing import (
+    Optional,
+    List,
+    Dict,
+    Tuple,
+    Any,
+    Callable,
+    Set,
+)
 from datetime import datetime
 import time
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 import boto3
+import requests
 from botocore.client import Config
+from requests.adapters import HTTPAdapter
 from sentinelhub import (
     SHConfig,
+    DownloadRequest,
+    MimeType,
+    SentinelHubDownloadClient,
     SentinelHubBYOC,
     ByocCollection,
     ByocCollectionAdditionalData,
     ByocCollectionBand,
     ByocTile,
+    DownloadFailedException,
 )
+from sentinelhub.constants import RequestType
+
+# Fields required in the description of each band of a collection
+REQUIRED_BAND_FIELDS = ("name", "source", "bit_depth", "sample_format")
+# File extensions, lowercased, of the files listed as tiles
+TIFF_EXTENSIONS = frozenset({"tif", "tiff"})
+# Maximum number of key ranges listed concurrently in the S3 bucket
+LISTING_WORKERS = 16
+# Size of the connection pool of the S3 client shared by the listing threads
+S3_MAX_POOL_CONNECTIONS = 32
+# Maximum number of threads used to create tiles in Sentinel Hub
+TILE_CREATION_THREADS = 32
+# Size of the keep-alive connection pool of the BYOC client
+BYOC_POOL_CONNECTIONS = 32
+# Delays in seconds between checks that a new collection is available
+COLLECTION_POLL_DELAYS = (0.1, 0.2, 0.4, 0.8, 1.6, 3.2)
+# Time in seconds during which the fetched paths of the collection tiles are reused
+TILE_CACHE_TTL = 30
+# Report entries of the tile statuses, any other status is counted as pending
+STATUS_TO_REPORT_KEY = {"INGESTED": "Ingested", "FAILED": "Failed"}
+
+
+def _is_tiff(key: str) -> bool:
+    """
+    Check whether an S3 key points to a TIFF file.
+
+    Args:
+        key: The S3 object key
+
+    Returns:
+        bool: True if the key has a .tif or .tiff extension (case-insensitive)
+    """
+    _, dot, extension = key.rpartition(".")
+    return bool(dot) and extension.lower() in TIFF_EXTENSIONS
+
+
+def _make_tile_path_parser(
+    sensing_time_position: Dict[str, Any], band_position: Dict[str, Any]
+) -> Callable[[str], Tuple[str, str]]:
+    """
+    Build a parser of file paths for the given path layout.
+
+    The layout parameters are unpacked once so that parsing each path does not
+    look them up again.
+
+    Args:
+        sensing_time_position: Dictionary with parameters for extracting datetime
+        band_position: Dictionary with parameters for identifying bands
+
+    Returns:
+        Callable[[str], Tuple[str, str]]: A function taking a file path and returning:
+            - Tile path with (BAND) placeholder
+            - Datetime string of the sensing time
+    """
+    datetime_path = sensing_time_position["path"]
+    datetime_delimiter = sensing_time_position["delimiter"]
+    datetime_index = sensing_time_position["position"]
+    band_path = band_position["path"]
+    band_delimiter = band_position["delimiter"]
+    band_index = band_position["position"]
+
+    def _parse(tile_path: str) -> Tuple[str, str]:
+        path_parts = tile_path.split("/")
+        # Get the sensing time from the tile path
+        folder_name = path_parts[datetime_path]
+        datetime_str = folder_name.split(datetime_delimiter)[datetime_index]
+        file_name = path_parts[band_path]
+        # Replace the band identifier, without splitting the whole name if it
+        # is the last or first part
+        if band_index == -1:
+            head, delimiter, _ = file_name.rpartition(band_delimiter)
+            new_file_name = f"{head}{delimiter}(BAND)"
+        elif band_index == 0:
+            _, delimiter, tail = file_name.partition(band_delimiter)
+            new_file_name = f"(BAND){delimiter}{tail}"
+        else:
+            split_file_name = file_name.split(band_delimiter)
+            split_file_name[band_index] = "(BAND)"
+            new_file_name = band_delimiter.join(split_file_name)
+        parent_path = path_parts[:-1]
+        return f"{'/'.join(parent_path)}/{new_file_name}", datetime_str
+
+    return _parse
 
 
 class TileListParameters:
@@ -29,12 +130,72 @@ class TileListParameters:
         creodias_username: str,
         creodias_password: str,
         bucket_url: Optional[str] = "eodata.dataspace.copernicus.eu",
+        manifest_key: Optional[str] = None,
     ):
         self.bucket_url = bucket_url
         self.base_path = base_path
         self.bucket_name = bucket_name
         self.creodias_username = creodias_username
         self.creodias_password = creodias_password
+        # Optional key of a JSON manifest listing the files, used instead of listing
+        self.manifest_key = manifest_key
+
+
+class _KeepAliveDownloadClient(SentinelHubDownloadClient):
+    """
+    Sentinel Hub download client that reuses connections between requests.
+
+    The default client opens a new connection, with its TCP and TLS handshakes, for
+    every request. This client sends requests through a pooled adapter shared by one
+    requests.Session per thread. Retries are left to the Sentinel Hub client.
+    """
+
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.adapter = HTTPAdapter(
+            pool_connections=BYOC_POOL_CONNECTIONS,
+            pool_maxsize=BYOC_POOL_CONNECTIONS,
+            max_retries=0,
+        )
+        self._thread_local = threading.local()
+
+    def _get_http_session(self) -> requests.Session:
+        """
+        Return the session of the calling thread, mounted on the shared adapter.
+
+        Returns:
+            requests.Session: The session used to send requests
+        """
+        if not hasattr(self._thread_local, "http_session"):
+            http_session = requests.Session()
+            http_session.mount("https://", self.adapter)
+            http_session.mount("http://", self.adapter)
+            self._thread_local.http_session = http_session
+        return self._thread_local.http_session
+
+    def _do_download(self, request: DownloadRequest) -> requests.Response:
+        """
+        Run the request over a pooled session.
+
+        Overrides a private method, checked against sentinelhub 3.12 where it only
+        differs by calling requests.request.
+
+        Args:
+            request: The Sentinel Hub download request
+
+        Returns:
+            requests.Response: The response of the request
+        """
+        if request.url is None:
+            raise ValueError(f"Faulty request {request}, no URL specified.")
+
+        return self._get_http_session().request(
+            request.request_type.value,
+            url=request.url,
+            json=request.post_values,
+            headers=self._prepare_headers(request),
+            timeout=self.config.download_timeout_seconds,
+        )
 
 
 class Ingestor:
@@ -55,6 +216,9 @@ class Ingestor:
         self.byoc_client = self.initialise_byoc_client(config)
         self.byoc_collection = None
         self.file_list = []
+        self._s3_client = None
+        self._s3_client_key = None
+        self._existing_paths_cache = None
 
     def initialise_byoc_client(self, config: SHConfig) -> SentinelHubBYOC:
         """
@@ -66,7 +230,13 @@ class Ingestor:
         Returns:
             sentinelhub.api.byoc.SentinelHubBYOC: A client for interacting with the BYOC API
         """
-        return SentinelHubBYOC(config=config)
+        byoc_client = SentinelHubBYOC(config=config)
+        # Reuse connections across the many requests made for tiles
+        byoc_client.client = _KeepAliveDownloadClient(
+            config=byoc_client.config,
+            default_retry_time=SentinelHubBYOC._DEFAULT_RETRY_TIME,
+        )
+        return byoc_client
 
     def create_byoc_collection(
         self,
@@ -90,27 +260,24 @@ class Ingestor:
             None: The created collection is stored in self.byoc_collection
         """
         if band_information is not None:
-            # Define the bands
-            band_parameters = {}
-            # Define the required fields
-            required_fields = ["name", "source", "bit_depth", "sample_format"]
-
             # Check for required fields in each band
             for band in band_information:
                 missing_fields = [
-                    field for field in required_fields if field not in band
+                    field for field in REQUIRED_BAND_FIELDS if field not in band
                 ]
                 if missing_fields:
-                    raise ValueError(
-                        f"Each band must contain {', '.join(missing_fields)} fields"
-                    )
-                # Build the band parameters
-                band_parameters[band["name"]] = ByocCollectionBand(
+                    missing = ", ".join(missing_fields)
+                    raise ValueError(f"Each band must contain {missing} fields")
+            # Define the bands
+            band_parameters = {
+                band["name"]: ByocCollectionBand(
                     source=band["source"],
                     band_index=1,
                     bit_depth=band["bit_depth"],
                     sample_format=band["sample_format"],
                 )
+                for band in band_information
+            }
             if storage_id:
                 band_config = ByocCollectionAdditionalData(
                     bands=band_parameters, other_data={"storageIdentifier": storage_id}
@@ -132,7 +299,130 @@ class Ingestor:
         )
 
         self.byoc_collection = self.byoc_client.create_collection(new_collection)
-        time.sleep(5)
+        self._existing_paths_cache = None
+
+        # Wait until the new collection has propagated
+        for delay in COLLECTION_POLL_DELAYS:
+            try:
+                self.byoc_client.get_collection(self.byoc_collection)
+                break
+            except DownloadFailedException:
+                time.sleep(delay)
+        else:
+            logging.warning(
+                "Collection %s is not available yet", self.byoc_collection["id"]
+            )
+
+    def _get_s3_client(self, params: TileListParameters):
+        """
+        Return the S3 client for the given parameters, creating it on first use.
+
+        The client is cached on the Ingestor for the bucket URL and credentials, and is
+        shared by the listing threads since boto3 clients are thread-safe.
+
+        Args:
+            params: TileListParameters object containing S3 access information
+
+        Returns:
+            botocore.client.S3: A client for the S3 endpoint
+        """
+        client_key = (
+            params.bucket_url,
+            params.creodias_username,
+            params.creodias_password,
+        )
+        if self._s3_client is None or self._s3_client_key != client_key:
+            session = boto3.session.Session()
+            self._s3_client = session.client(
+                "s3",
+                endpoint_url=f"https://{params.bucket_url}",
+                aws_access_key_id=params.creodias_username,
+                aws_secret_access_key=params.creodias_password,
+                config=Config(
+                    signature_version="s3v4",
+                    max_pool_connections=S3_MAX_POOL_CONNECTIONS,
+                    retries={"max_attempts": 10, "mode": "adaptive"},
+                ),
+                verify=True,  # Check SSL certificate
+            )
+            self._s3_client_key = client_key
+        return self._s3_client
+
+    def _split_key_range(
+        self, params: TileListParameters, prefix: str, max_ranges: int
+    ) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """
+        Split the keys below a prefix into contiguous lexicographic ranges.
+
+        The range boundaries are evenly spaced sub-folders of the prefix, taken from the
+        first page of a delimited listing. A prefix without sub-folders is one range.
+
+        Args:
+            params: TileListParameters object containing S3 access information
+            prefix: The key prefix to split
+            max_ranges: Maximum number of ranges to split the prefix into
+
+        Returns:
+            List[Tuple[str, Optional[str], Optional[str]]]: List of tuples containing:
+                - The key prefix
+                - The key after which the range starts (None for the first range)
+                - The last key of the range (None for the last range)
+        """
+        response = self._get_s3_client(params).list_objects_v2(
+            Bucket=params.bucket_name, Prefix=prefix, Delimiter="/"
+        )
+        sub_prefixes = [
+            common_prefix["Prefix"]
+            for common_prefix in response.get("CommonPrefixes", [])
+        ]
+        num_ranges = min(max_ranges, len(sub_prefixes))
+        if num_ranges <= 1:
+            return [(prefix, None, None)]
+
+        # Keys below a sub-folder sort after it, so they start the next range
+        bounds = [
+            sub_prefixes[len(sub_prefixes) * index // num_ranges]
+            for index in range(1, num_ranges)
+        ]
+        bounds = [None, *bounds, None]
+        return [(prefix, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def _list_key_range(
+        self,
+        params: TileListParameters,
+        prefix: str,
+        start_after: Optional[str] = None,
+        end_key: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Recursively list all TIFF files below a prefix within a range of keys.
+
+        Args:
+            params: TileListParameters object containing S3 access information
+            prefix: The key prefix to list
+            start_after: Only list keys after this key (from the first key if None)
+            end_key: Only list keys up to this key included (to the last key if None)
+
+        Returns:
+            List[str]: The TIFF file paths found in the range
+        """
+        paginator = self._get_s3_client(params).get_paginator("list_objects_v2")
+        operation_parameters = {
+            "Bucket": params.bucket_name,
+            "Prefix": prefix,
+            "PaginationConfig": {"PageSize": 1000},
+        }
+        if start_after is not None:
+            operation_parameters["StartAfter"] = start_after
+        tiff_files = []
+        for page in paginator.paginate(**operation_parameters):
+            for obj in page.get("Contents", []):
+                # Keys are returned in lexicographic order
+                if end_key is not None and obj["Key"] > end_key:
+                    return tiff_files
+                if _is_tiff(obj["Key"]):
+                    tiff_files.append(obj["Key"])
+        return tiff_files
 
     def list_tiles(self, params: TileListParameters) -> List[str]:
         """
@@ -140,6 +430,12 @@ class Ingestor:
 
         This function connects to an S3 bucket, recursively searches for all TIFF files
         (.tif or .tiff) within the specified base path, and stores them in self.file_list.
+        The first level of sub-folders is discovered with a delimited listing and the
+        sub-folders, or key ranges within them when there are few, are then listed
+        concurrently.
+
+        If params.manifest_key is set, the bucket is not listed and the TIFF files below
+        the base path are read from the manifest instead, a JSON list of the object keys.
 
         Args:
             params: TileListParameters object containing S3 access information
@@ -147,37 +443,59 @@ class Ingestor:
         Returns:
             List[str]: The list of file paths found (also stored in self.file_list)
         """
-        # Create a session and client
-        session = boto3.session.Session()
-        s3_client = session.client(
-            "s3",
-            endpoint_url=f"https://{params.bucket_url}",
-            aws_access_key_id=params.creodias_username,
-            aws_secret_access_key=params.creodias_password,
-            config=Config(signature_version="s3v4"),
-            verify=True,  # Check SSL certificate
-        )
+        if params.manifest_key is not None:
+            response = self._get_s3_client(params).get_object(
+                Bucket=params.bucket_name, Key=params.manifest_key
+            )
+            manifest = json.loads(response["Body"].read())
+            if not isinstance(manifest, list) or not all(
+                isinstance(key, str) for key in manifest
+            ):
+                raise ValueError(
+                    f"Manifest {params.manifest_key} must be a JSON list of object keys"
+                )
+            # Keep the same files as listing the base path would
+            self.file_list = [
+                key
+                for key in manifest
+                if key.startswith(params.base_path) and _is_tiff(key)
+            ]
+            return self.file_list
 
-        # Use a paginator to handle large result sets
-        paginator = s3_client.get_paginator("list_objects_v2")
+        # Discover the first level of sub-folders to shard the listing
+        paginator = self._get_s3_client(params).get_paginator("list_objects_v2")
         operation_parameters = {
             "Bucket": params.bucket_name,
             "Prefix": params.base_path,
+            "Delimiter": "/",
         }
         tiff_files = []
+        prefixes = []
         for page in paginator.paginate(**operation_parameters):
-            if "Contents" in page:
-                for obj in page["Contents"]:
-                    # Get all subfolders
-                    for subpages in paginator.paginate(
-                        Bucket=params.bucket_name, Prefix=obj["Key"]
-                    ):
-                        if "Contents" in subpages:
-                            for subobj in subpages["Contents"]:
-                                if subobj["Key"].endswith(
-                                    (".tiff", ".tif", ".TIF", ".TIFF")
-                                ):
-                                    tiff_files.append(subobj["Key"])
+            # Files sitting directly under the base path
+            for obj in page.get("Contents", []):
+                if _is_tiff(obj["Key"]):
+                    tiff_files.append(obj["Key"])
+            for common_prefix in page.get("CommonPrefixes", []):
+                prefixes.append(common_prefix["Prefix"])
+
+        with ThreadPoolExecutor(max_workers=LISTING_WORKERS) as executor:
+            # With few sub-folders, also split each of them into key ranges
+            if len(prefixes) >= LISTING_WORKERS:
+                key_ranges = [(prefix, None, None) for prefix in prefixes]
+            else:
+                max_ranges = LISTING_WORKERS // max(len(prefixes), 1)
+                key_ranges = []
+                for prefix_ranges in executor.map(
+                    lambda prefix: self._split_key_range(params, prefix, max_ranges),
+                    prefixes,
+                ):
+                    key_ranges.extend(prefix_ranges)
+
+            for range_files in executor.map(
+                lambda key_range: self._list_key_range(params, *key_range), key_ranges
+            ):
+                tiff_files.extend(range_files)
 
         self.file_list = tiff_files
         return tiff_files
@@ -208,28 +526,53 @@ class Ingestor:
                 - Tile path with (BAND) placeholder
                 - Datetime object representing sensing time
         """
+        parse_tile_path = _make_tile_path_parser(sensing_time_position, band_position)
         byoc_tiles = []
+        seen_paths = set()
+        # Files of one acquisition share the same folder, parse each date once
+        datetime_format = sensing_time_position["format"]
+        datetime_cache: Dict[str, datetime] = {}
         for tile_path in self.file_list:
-            # Get the sensing time from the tile path
-            folder_name = tile_path.split("/")[sensing_time_position["path"]]
-            datetime_str = folder_name.split(sensing_time_position["delimiter"])[
-                sensing_time_position["position"]
-            ]
-            datetime_obj = datetime.strptime(
-                datetime_str, sensing_time_position["format"]
-            )
-            file_name = tile_path.split("/")[band_position["path"]]
-            split_file_name = file_name.split(band_position["delimiter"])
-            split_file_name[band_position["position"]] = "(BAND)"
-            new_file_name = band_position["delimiter"].join(split_file_name)
-            parent_path = tile_path.split("/")[0:-1]
-            byoc_path = f"{'/'.join(parent_path)}/{new_file_name}"
+            byoc_path, datetime_str = parse_tile_path(tile_path)
+            datetime_obj = datetime_cache.get(datetime_str)
+            if datetime_obj is None:
+                datetime_obj = datetime.strptime(datetime_str, datetime_format)
+                datetime_cache[datetime_str] = datetime_obj
 
-            if not byoc_path in [x[0] for x in byoc_tiles]:
-                byoc_tiles.append([byoc_path, datetime_obj])
+            if byoc_path in seen_paths:
+                continue
+            seen_paths.add(byoc_path)
+            byoc_tiles.append([byoc_path, datetime_obj])
 
         return byoc_tiles
 
+    def _get_existing_paths(self) -> Set[str]:
+        """
+        Return the paths of the tiles already in the BYOC collection.
+
+        The paths are cached for TILE_CACHE_TTL seconds, and the paths of the tiles
+        created in the meantime are added to them, so that consecutive ingestions do
+        not fetch the whole collection again.
+
+        Returns:
+            Set[str]: The paths of the tiles of self.byoc_collection
+        """
+        collection_id = self.byoc_collection["id"]
+        if self._existing_paths_cache is not None:
+            cache_time, cache_collection_id, paths = self._existing_paths_cache
+            if (
+                cache_collection_id == collection_id
+                and time.monotonic() - cache_time < TILE_CACHE_TTL
+            ):
+                return paths
+
+        fetch_time = time.monotonic()
+        paths = {
+            tile["path"] for tile in self.byoc_client.iter_tiles(self.byoc_collection)
+        }
+        self._existing_paths_cache = (fetch_time, collection_id, paths)
+        return paths
+
     def ingest_tiles_to_collection(
         self, sensing_time_position: Dict[str, Any], band_position: Dict[str, Any]
     ) -> None:
@@ -251,12 +594,59 @@ class Ingestor:
             The collection must be created first (using create_byoc_collection)
             Tiles are created in Sentinel Hub but actual data ingestion happens asynchronously
         """
-        byoc_tiles = self.build_byoc_tiles(sensing_time_position, band_position)
-        existing_tiles = list(self.byoc_client.iter_tiles(self.byoc_collection))
-        for tile in byoc_tiles:
-            byoc_tile = ByocTile(path=tile[0], sensing_time=tile[1])
-            if byoc_tile.path not in [x.path for x in existing_tiles]:
-                self.byoc_client.create_tile(self.byoc_collection, byoc_tile)
+        # Fetch the existing tiles while the new tiles are being built
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            existing_paths_future = executor.submit(self._get_existing_paths)
+            byoc_tiles = self.build_byoc_tiles(sensing_time_position, band_position)
+            existing_paths = existing_paths_future.result()
+
+        new_tiles = [
+            ByocTile(path=tile[0], sensing_time=tile[1])
+            for tile in byoc_tiles
+            if tile[0] not in existing_paths
+        ]
+        self.create_tiles(new_tiles)
+
+    def create_tiles(self, tiles: List[ByocTile]) -> None:
+        """
+        Create tiles in the BYOC collection.
+
+        The tiles are created concurrently by the download client of the BYOC client,
+        which applies the Sentinel Hub rate limits and retries. A tile that cannot be
+        created raises a DownloadFailedException.
+
+        Args:
+            tiles: The tiles to create in self.byoc_collection
+        """
+        if not tiles:
+            return
+        # Tiles may be partly created if the download fails, so the cached paths are
+        # only kept, with the new paths, once all tiles are created
+        existing_paths_cache = self._existing_paths_cache
+        self._existing_paths_cache = None
+
+        url = (
+            f"{self.byoc_client.service_url}/collections/"
+            f"{self.byoc_collection['id']}/tiles"
+        )
+        # Same requests as SentinelHubBYOC.create_tile, downloaded in parallel
+        download_requests = [
+            DownloadRequest(
+                url=url,
+                headers={"Content-Type": MimeType.JSON.get_string()},
+                request_type=RequestType.POST,
+                post_values=tile.to_dict(),
+                use_session=True,
+                data_type=MimeType.JSON,
+            )
+            for tile in tiles
+        ]
+        self.byoc_client.client.download(
+            download_requests, max_threads=TILE_CREATION_THREADS
+        )
+        if existing_paths_cache is not None:
+            existing_paths_cache[2].update(tile.path for tile in tiles)
+            self._existing_paths_cache = existing_paths_cache
 
     def collection_tile_report(self) -> Tuple[Dict[str, int], List[str]]:
         """
@@ -267,16 +657,13 @@ class Ingestor:
                 - A dictionary with counts of tiles by status (Ingested, Failed, Pending, Total)
                 - A list of failure reasons for failed tiles
         """
-        tiles = list(self.byoc_client.iter_tiles(self.byoc_collection))
-
-        report = {"Ingested": 0, "Failed": 0, "Pending": 0, "Total": len(tiles)}
+        statuses = []
         failed = []
 
-        for tile in tiles:
-            if tile["status"] == "INGESTED":
-                report["Ingested"] += 1
-            elif tile["status"] == "FAILED":
-                report["Failed"] += 1
+        for tile in self.byoc_client.iter_tiles(self.byoc_collection):
+            key = STATUS_TO_REPORT_KEY.get(tile["status"], "Pending")
+            statuses.append(key)
+            if key == "Failed":
                 # Safely extract failure cause if available
                 if (
                     "additionalData" in tile
@@ -285,7 +672,13 @@ class Ingestor:
                     failed.append(tile["additionalData"]["failedIngestionCause"])
                 else:
                     failed.append(f"Unknown failure for tile {tile['path']}")
-            else:
-                report["Pending"] += 1
+
+        counts = Counter(statuses)
+        report = {
+            "Ingested": counts["Ingested"],
+            "Failed": counts["Failed"],
+            "Pending": counts["Pending"],
+            "Total": len(statuses),
+        }
 
         return report, failed